@@ -1,16 +1,27 @@
-import json
 import asyncio
+import mmap
+import argparse
+import sys
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, FileModifiedEvent
 import uvicorn
+import orjson
+
+
+# Seconds to wait after a change before broadcasting, so bursts of appends
+# are sent to clients as a single message
+BROADCAST_INTERVAL = 0.016
+
+# Number of entries per message when sending the log to a new client
+INITIAL_PAGE_SIZE = 100
 
 
 class LogFileHandler(FileSystemEventHandler):
@@ -18,6 +29,7 @@ class LogFileHandler(FileSystemEventHandler):
     
     def __init__(self, websocket_manager):
         self.websocket_manager = websocket_manager
+        self.log_path = str(websocket_manager.log_file.resolve())
         self._loop = None
     
     def set_event_loop(self, loop):
@@ -25,13 +37,10 @@ class LogFileHandler(FileSystemEventHandler):
         self._loop = loop
     
     def on_modified(self, event):
-        if not event.is_directory and event.src_path.endswith("log.jsonl"):
+        if event.src_path == self.log_path:
             if self._loop and not self._loop.is_closed():
-                # Schedule the coroutine in the main event loop
-                asyncio.run_coroutine_threadsafe(
-                    self.websocket_manager.broadcast_latest_log(), 
-                    self._loop
-                )
+                # Wake the broadcaster in the main event loop
+                self._loop.call_soon_threadsafe(self.websocket_manager.mark_dirty)
 
 
 class WebSocketManager:
@@ -40,18 +49,36 @@ class WebSocketManager:
     def __init__(self):
         self.active_connections: list[WebSocket] = []
         self.log_file = Path("log.jsonl")
+        # Raw JSON lines and how far into log.jsonl they were read
+        self._raw_lines: list[bytes] = []
+        self._offset: int = 0
+        self._inode: Optional[int] = None
+        # Number of cached lines already broadcast to clients
+        self._sent: int = 0
+        # Set when log.jsonl changed and clients need an update
+        self._dirty = asyncio.Event()
     
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
-        # Send all log entries immediately upon connection
-        all_entries = self.get_all_log_entries()
+        # Send all log entries immediately upon connection, in pages so a long
+        # log is never serialized into one giant message
+        # Lines not broadcast yet are left for the broadcaster to deliver
+        all_entries = self.get_all_log_entries()[:self._sent]
+        if len(self._raw_lines) > self._sent:
+            self.mark_dirty()
+        total = len(all_entries)
         try:
-            await websocket.send_json({
-                "type": "initial",
-                "entries": all_entries,
-                "total": len(all_entries)
-            })
+            # Raw lines are spliced into the message envelope as-is
+            page = b','.join(all_entries[:INITIAL_PAGE_SIZE])
+            payload = b'{"type":"initial","entries":[%b],"total":%d}' % (page, total)
+            await websocket.send_text(payload.decode())
+            for start in range(INITIAL_PAGE_SIZE, total, INITIAL_PAGE_SIZE):
+                # Let broadcasts and other clients run between pages
+                await asyncio.sleep(0)
+                page = b','.join(all_entries[start:start + INITIAL_PAGE_SIZE])
+                payload = b'{"type":"initial_chunk","entries":[%b]}' % page
+                await websocket.send_text(payload.decode())
         except Exception:
             self.disconnect(websocket)
     
@@ -59,103 +86,149 @@ class WebSocketManager:
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
     
-    async def broadcast_latest_log(self):
-        """Broadcast the most recent log entry to all connected clients"""
-        if not self.active_connections:
-            return
+    def mark_dirty(self):
+        """Flag that log.jsonl changed; must be called from the event loop thread"""
+        self._dirty.set()
+    
+    async def run_broadcaster(self):
+        """Broadcast newly appended log entries, coalescing bursts of changes"""
+        # Entries already in the log are delivered by connect(), not broadcast
+        self.get_all_log_entries()
+        self._sent = len(self._raw_lines)
         
-        latest_entry = self.get_latest_log_entry()
-        if latest_entry:
-            disconnected = []
-            for connection in self.active_connections:
-                try:
-                    await connection.send_json({
-                        "type": "update",
-                        "entry": latest_entry
-                    })
-                except Exception:
-                    disconnected.append(connection)
-            
-            # Remove disconnected clients
-            for connection in disconnected:
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            await asyncio.sleep(BROADCAST_INTERVAL)
+            await self.broadcast_new_entries()
+    
+    async def broadcast_new_entries(self):
+        """Broadcast all entries appended since the last broadcast to all connected clients"""
+        raw_lines = self.get_all_log_entries()
+        new_entries = raw_lines[self._sent:]
+        self._sent = len(raw_lines)
+        
+        if new_entries and self.active_connections:
+            # Wrap the raw lines once for all clients
+            payload = b'{"type":"update","entries":[%b]}' % b','.join(new_entries)
+            await self._broadcast(payload.decode())
+    
+    async def _broadcast(self, payload: str):
+        """Send a pre-serialized message to all clients concurrently"""
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_text(payload) for connection in connections),
+            return_exceptions=True
+        )
+        
+        # Remove disconnected clients
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
                 self.disconnect(connection)
     
-    def get_latest_log_entry(self) -> Optional[Dict[str, Any]]:
-        """Read the last line from log.jsonl and return parsed JSON"""
+    def get_all_log_entries(self) -> list[bytes]:
+        """Return all entries from log.jsonl as raw JSON, reading only bytes appended since the last call"""
         try:
             if not self.log_file.exists():
-                return None
+                self._reset_cache()
+                return self._raw_lines
             
-            with open(self.log_file, 'r') as f:
-                lines = f.readlines()
-                if not lines:
-                    return None
-                
-                # Get the last non-empty line
-                for line in reversed(lines):
-                    line = line.strip()
-                    if line:
-                        entry = json.loads(line)
-                        # Add timestamp for display if not present
-                        if 'timestamp' not in entry:
-                            entry['timestamp'] = datetime.now().isoformat()
-                        return entry
-                
-                return None
-        except Exception as e:
-            print(f"Error reading log file: {e}")
-            return None
-    
-    def get_all_log_entries(self) -> list[Dict[str, Any]]:
-        """Read all entries from log.jsonl and return as a list"""
-        entries = []
-        try:
-            if not self.log_file.exists():
-                return entries
+            # Start over if the log was rotated or truncated
+            st = self.log_file.stat()
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self._reset_cache()
+                self._inode = st.st_ino
+            
+            if st.st_size == self._offset:
+                return self._raw_lines
             
-            with open(self.log_file, 'r') as f:
-                for line in f:
-                    line = line.strip()
+            # Map the file and slice lines straight out of the page cache
+            # instead of copying them through a read buffer first. Note that
+            # truncating log.jsonl while it is mapped here can raise SIGBUS
+            # and kill the process; rotate the log (rename) rather than
+            # truncating it in place while the dashboard is running.
+            with open(self.log_file, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Leave a partially written last line for the next call
+                end = mm.rfind(b'\n', self._offset) + 1
+                while self._offset < end:
+                    newline = mm.find(b'\n', self._offset, end)
+                    line = mm[self._offset:newline].strip()
+                    # Advance per line, so a failure part-way never re-reads
+                    # (and duplicates) lines that were already cached
+                    self._offset = newline + 1
                     if line:
-                        try:
-                            entry = json.loads(line)
-                            # Add timestamp for display if not present
-                            if 'timestamp' not in entry:
-                                entry['timestamp'] = datetime.now().isoformat()
-                            entries.append(entry)
-                        except json.JSONDecodeError:
-                            continue
+                        raw_line = self._with_timestamp(line)
+                        if raw_line is not None:
+                            self._raw_lines.append(raw_line)
             
-            return entries
+            return self._raw_lines
         except Exception as e:
             print(f"Error reading log file: {e}")
-            return entries
+            return self._raw_lines
+    
+    @staticmethod
+    def _with_timestamp(line: bytes) -> Optional[bytes]:
+        """Return a log line that carries a timestamp, re-encoding it only if it has none"""
+        # Always parse, so a malformed line is skipped (None) instead of breaking
+        # the whole message it would be spliced into
+        try:
+            entry = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            return None
+        if not isinstance(entry, dict):
+            return None
+        
+        # proxy.py stamps every record, so its lines are forwarded verbatim
+        if 'timestamp' in entry:
+            return line
+        
+        # Add timestamp for display if not present
+        entry['timestamp'] = datetime.now().isoformat()
+        return orjson.dumps(entry)
+    
+    def _reset_cache(self):
+        """Drop cached entries so the log is re-read from the start"""
+        self._raw_lines = []
+        self._sent = 0
+        self._offset = 0
+        self._inode = None
 
 
 # Initialize WebSocket manager
 websocket_manager = WebSocketManager()
 
-# Set up file watcher
-log_handler = LogFileHandler(websocket_manager)
-observer = Observer()
-observer.schedule(log_handler, path=".", recursive=False)
-
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage startup and shutdown events"""
     # Startup
+    # The file watcher is created here rather than at import time so that
+    # each uvicorn worker process tails log.jsonl with its own observer
+    log_handler = LogFileHandler(websocket_manager)
     log_handler.set_event_loop(asyncio.get_running_loop())
+    observer = Observer()
+    # Only subscribe to modifications so unrelated churn in the directory (creates,
+    # moves, deletes, attribute changes) is filtered out by the OS backend
+    observer.schedule(
+        log_handler,
+        path=str(websocket_manager.log_file.resolve().parent),
+        recursive=False,
+        event_filter=[FileModifiedEvent]
+    )
+    broadcaster = asyncio.create_task(websocket_manager.run_broadcaster())
     observer.start()
     print("📁 File watcher started - monitoring log.jsonl")
     yield
     # Shutdown
     observer.stop()
     observer.join()
+    broadcaster.cancel()
 
 
 # Initialize FastAPI app
-app = FastAPI(title="OpenRouter Request Dashboard", version="1.0.0", lifespan=lifespan)
+app = FastAPI(title="OpenRouter Request Dashboard", version="1.0.0", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -173,22 +246,43 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket_manager.connect(websocket)
     try:
         while True:
-            # Keep the connection alive
-            await websocket.receive_text()
+            # Clients never send anything meaningful; just wait for the disconnect
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
     except WebSocketDisconnect:
+        pass
+    finally:
         websocket_manager.disconnect(websocket)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Real-time dashboard for logged API requests")
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                       help="Number of worker processes (default: 1)")
+    
+    args = parser.parse_args()
+    
     print("🚀 Starting OpenRouter Dashboard...")
     print("📊 Dashboard will be available at: http://localhost:8000")
     print("🔗 WebSocket endpoint: ws://localhost:8000/ws")
     print("📡 Monitoring: log.jsonl")
     print("\nPress Ctrl+C to stop\n")
     
+    # Each worker keeps its own connections and log cache; a browser only
+    # talks to the worker that accepted its WebSocket
     uvicorn.run(
-        app,
+        "dashboard:app",
+        workers=args.workers,
         host="0.0.0.0",
         port=8000,
-        log_level="info"
+        log_level="info",
+        # uvloop is not available on Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # Protocol-level ping frames detect dead clients without app traffic
+        ws_ping_interval=20.0,
+        ws_ping_timeout=20.0,
+        access_log=False
     )
\ No newline at end of file
@@ -1,154 +1,350 @@
-import http.server
-import socketserver
-import urllib.request
-import threading
-import time
-import gzip
-import json
+import os
+import zlib
+import asyncio
+import orjson
 import argparse
+import logging
 import sys
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+
+log = logging.getLogger("proxy")
+
+# Responses larger than this are forwarded in full but logged as metadata only
+LOG_MAX_BYTES = 16 * 1024 * 1024
+
+# Hop-by-hop and recomputed headers that are not forwarded
+SKIP_REQUEST_HEADERS = frozenset({b'host', b'connection', b'content-length'})
+SKIP_RESPONSE_HEADERS = frozenset({b'connection', b'transfer-encoding'})
+
+# A 429/503 with a Retry-After of at most MAX_RETRY_AFTER seconds is retried
+# up to MAX_RETRIES times before the response is passed back to the client
+RETRY_STATUS_CODES = frozenset({429, 503})
+MAX_RETRIES = 2
+MAX_RETRY_AFTER = 10.0
+
+LOG_FILE = "log.jsonl"
+
+# Maximum number of log lines written to log.jsonl in one write
+LOG_BATCH_SIZE = 256
+
+# Log lines waiting to be appended to log.jsonl by log_writer()
+log_queue: asyncio.Queue = asyncio.Queue()
+
+# Most buffers passed to a single writev() call (the POSIX IOV_MAX on Linux/macOS)
+IOV_MAX = 1024
+
+# fdatasync is not available on every platform (e.g. macOS, Windows)
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+class ResponseCapture:
+    """Keeps a decoded copy of a streamed response body for the log"""
+
+    def __init__(self, max_bytes=LOG_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.body = bytearray()
+        self.raw_bytes = 0
+        self.too_large = False
+        self.error = None
+        self._decompressor = None
+
+    def feed(self, chunk: bytes):
+        self.raw_bytes += len(chunk)
+        if self.too_large or self.error:
+            return
+
+        # Decompress gzipped bodies chunk by chunk, never beyond what will be logged
+        if self.raw_bytes == len(chunk) and chunk.startswith(b'\x1f\x8b'):
+            self._decompressor = zlib.decompressobj(wbits=31)
+        if self._decompressor:
+            try:
+                room = self.max_bytes - len(self.body) + 1
+                chunk = self._decompressor.decompress(chunk, room)
+            except zlib.error as decode_error:
+                self.error = f"Decoding error: {str(decode_error)}"
+                return
+            if self._decompressor.unconsumed_tail:
+                self.too_large = True
+                return
+
+        self.body += chunk
+        if len(self.body) > self.max_bytes:
+            self.too_large = True
+
+    def result(self):
+        """Return the captured body as something JSON-serializable for the log"""
+        if self.too_large:
+            return {"error": "Response too large to log", "raw_bytes": self.raw_bytes}
+        if self.error:
+            return {"error": self.error, "raw_bytes": self.raw_bytes}
+
+        try:
+            decoded_text = self.body.decode('utf-8')
+        except UnicodeDecodeError:
+            return {"error": "Binary response received", "raw_bytes": self.raw_bytes}
 
-class ProxyHandler(http.server.BaseHTTPRequestHandler):
-    target_url = "https://api.anthropic.com"  # Default to Anthropic (without /v1)
-    
-    def log_message(self, format, *args):
-        pass  # Suppress logs
-    
-    def do_POST(self):
-        self.proxy_request()
-    
-    def do_GET(self):
-        self.proxy_request()
-    
-    def proxy_request(self):
-        request_json = ""
-        response_json = None
-        
         try:
-            # Read request body
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length) if content_length > 0 else b''
-            
-            # Print basic info
-            print(f"{self.command} {self.path}")
-            print(f"Forwarding to: {self.target_url}{self.path}")
-            print(f"Headers received: {dict(self.headers)}")
-            request_json = body.decode('utf-8', errors='ignore')
-            print(f"Body length: {len(body)} bytes")
-
-            # Forward to target URL
-            url = f"{self.target_url}{self.path}"
-            headers = {k: v for k, v in self.headers.items() 
-                      if k.lower() not in ['host', 'connection', 'content-length']}
-            
-            # Set content-length if we have a body
-            if body:
-                headers['Content-Length'] = str(len(body))
-            
-            req = urllib.request.Request(url, data=body, headers=headers, method=self.command)
-            
-            # Make request
-            with urllib.request.urlopen(req) as response:
-                response_body = response.read()
-                
-                # Decompress if gzipped, then decode and pretty-print
+            return orjson.loads(decoded_text)
+        except orjson.JSONDecodeError:
+            return {"raw_response": decoded_text}
+
+
+@dataclass(slots=True)
+class LogRecord:
+    """One request/response pair as written to log.jsonl"""
+    # Every record is stamped, so the dashboard can forward lines without re-encoding them
+    timestamp: str
+    request: str
+    response: Any
+
+
+def write_log(request_json, response_json):
+    """Queue a LogRecord for request_json/response_json to be appended to log.jsonl"""
+    # orjson serializes dataclasses natively, with no intermediate dict
+    record = LogRecord(datetime.now().isoformat(), request_json, response_json)
+    log_queue.put_nowait(orjson.dumps(record) + b"\n")
+
+
+def open_log():
+    """Open log.jsonl for appending; O_APPEND keeps concurrent writers' lines intact"""
+    return os.open(LOG_FILE, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0), 0o644)
+
+
+def reopen_if_rotated(fd):
+    """Return fd, or a fresh one if log.jsonl was moved or deleted since fd was opened"""
+    if fd is None:
+        return open_log()
+    try:
+        current = os.stat(LOG_FILE)
+    except FileNotFoundError:
+        current = None
+    opened = os.fstat(fd)
+    if current is None or (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+        # Open the new file before closing the old one, so a failed open
+        # leaves fd valid for the caller
+        new_fd = open_log()
+        os.close(fd)
+        fd = new_fd
+    return fd
+
+
+def write_batch(fd, batch):
+    """Append a batch of log lines with as few writes as possible and one sync"""
+    if not hasattr(os, "writev"):
+        batch = [b"".join(batch)]
+    buffers = [memoryview(line) for line in batch]
+    first = 0
+    # write()/writev() may write less than asked for; resume from where it stopped
+    while first < len(buffers):
+        if first == len(buffers) - 1:
+            written = os.write(fd, buffers[first])
+        else:
+            # Gather write straight from the queued buffers, without joining them first
+            written = os.writev(fd, buffers[first:first + IOV_MAX])
+        while first < len(buffers) and written >= len(buffers[first]):
+            written -= len(buffers[first])
+            first += 1
+        if written:
+            buffers[first] = buffers[first][written:]
+    fdatasync(fd)
+
+
+async def log_writer():
+    """Drain the log queue into log.jsonl until a None sentinel is received"""
+    # One descriptor is kept open for the lifetime of the server
+    fd = None
+    try:
+        done = False
+        while not done:
+            batch = [await log_queue.get()]
+            while not log_queue.empty() and len(batch) < LOG_BATCH_SIZE:
+                batch.append(log_queue.get_nowait())
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if batch:
+                # Keep the disk I/O off the event loop serving requests. A failed
+                # batch is reported and dropped so the writer keeps running.
                 try:
-                    if response_body.startswith(b'\x1f\x8b'):
-                        decoded_text = gzip.decompress(response_body).decode('utf-8')
-                    else:
-                        decoded_text = response_body.decode('utf-8')
-                    
-                    try:
-                        response_json = json.loads(decoded_text)
-                    except json.JSONDecodeError:
-                        response_json = {"raw_response": decoded_text}
-                except UnicodeDecodeError:
-                    response_json = {"error": "Binary response received", "raw_bytes": len(response_body)}
-                except Exception as decode_error:
-                    response_json = {"error": f"Decoding error: {str(decode_error)}", "raw_bytes": len(response_body)}
-
-                # Send response back
-                self.send_response(response.status)
-                for k, v in response.headers.items():
-                    if k.lower() not in ['connection', 'transfer-encoding']:
-                        self.send_header(k, v)
-                self.end_headers()
-                self.wfile.write(response_body)
-                
-        except urllib.error.HTTPError as e:
-            error_body = e.read()
-            try:
-                decoded_error = error_body.decode('utf-8')
-                response_json = json.loads(decoded_error)
-            except json.JSONDecodeError:
-                response_json = {"error": error_body.decode('utf-8', errors='ignore')}
-            except UnicodeDecodeError:
-                response_json = {"error": "Binary response received", "raw_bytes": len(error_body)}
-            
-            self.send_response(e.code)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(error_body)
-        except Exception as e:
-            print(f"Error: {e}")
-            response_json = {"error": str(e)}
-            self.send_response(500)
-            self.end_headers()
-
-        # append {'request': request_json, 'response': response_json} to log.jsonl
-        if response_json is not None:
-            with open("log.jsonl", "a") as log_file:
-                log_file.write(json.dumps({'request': request_json, 'response': response_json}) + "\n")
+                    fd = await asyncio.to_thread(reopen_if_rotated, fd)
+                    await asyncio.to_thread(write_batch, fd, batch)
+                except OSError as e:
+                    log.error("Error writing %s, dropped %d record(s): %s", LOG_FILE, len(batch), e)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """Run the log writer and the upstream client for the lifetime of the server"""
+    writer = asyncio.create_task(log_writer())
+    # Shared upstream client: HTTP/2 and keep-alive let requests reuse one
+    # TLS connection to the target; no timeout, since LLM responses can take minutes
+    app.state.client = httpx.AsyncClient(
+        http2=True,
+        timeout=None,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=300),
+    )
+    yield
+    await app.state.client.aclose()
+    # Flush whatever is still queued before exiting
+    log_queue.put_nowait(None)
+    await writer
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """Return how long the target asked us to wait before retrying, if it did"""
+    if response.status_code not in RETRY_STATUS_CODES:
+        return None
+    value = response.headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        # Retry-After may also be an HTTP date
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return max(delay, 0.0)
+
+
+async def send_upstream(client: httpx.AsyncClient, upstream_request: httpx.Request) -> httpx.Response:
+    """Send a request to the target, waiting out short Retry-After responses"""
+    for _ in range(MAX_RETRIES):
+        upstream = await client.send(upstream_request, stream=True)
+        delay = retry_after_seconds(upstream)
+        if delay is None or delay > MAX_RETRY_AFTER:
+            return upstream
+        await upstream.aclose()
+        log.warning("Target returned %d, retrying in %.1fs", upstream.status_code, delay)
+        await asyncio.sleep(delay)
+    return await client.send(upstream_request, stream=True)
+
+
+async def proxy_request(request: Request) -> Response:
+    request_json = ""
+
+    try:
+        # Read request body
+        body = await request.body()
+        # Forward the path exactly as received (still percent-encoded), like
+        # target_url + path; request.url.path would decode %2F and friends
+        path = request.scope.get("raw_path", request.url.path.encode()).decode('latin-1')
+        if request.scope["query_string"]:
+            path += "?" + request.scope["query_string"].decode('latin-1')
+        url = httpx.URL(f"{request.app.state.target_url}{path}")
+
+        # Log basic info (only formatted when --verbose is on)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s %s", request.method, path)
+            log.debug("Forwarding to: %s", url)
+            log.debug("Headers received: %s", dict(request.headers))
+            log.debug("Body length: %d bytes", len(body))
+        request_json = body.decode('utf-8', errors='ignore')
+
+        # Forward to target URL (content-length is set by httpx from the body).
+        # ASGI already gives lowercase raw header names, so no per-key lower()
+        headers = [(k, v) for k, v in request.headers.raw if k not in SKIP_REQUEST_HEADERS]
+
+        client = request.app.state.client
+        # Always an absolute URL: as a relative one, a leading "//" would be
+        # read as a host
+        upstream_request = client.build_request(request.method, url, content=body, headers=headers)
+
+        # Make request; the body is streamed below, undecoded, exactly as sent
+        upstream = await send_upstream(client, upstream_request)
+
+    except Exception as e:
+        log.error("Error: %s", e)
+        write_log(request_json, {"error": str(e)})
+        return Response(status_code=500)
+
+    async def stream_upstream():
+        # Forward each chunk as soon as it arrives, keeping a decoded copy for
+        # the log only while the body is small enough to be worth logging
+        capture = ResponseCapture()
+        try:
+            async for chunk in upstream.aiter_raw():
+                capture.feed(chunk)
+                yield chunk
+        finally:
+            await upstream.aclose()
+            write_log(request_json, capture.result())
+
+    # Send response back
+    response = StreamingResponse(stream_upstream(), status_code=upstream.status_code)
+    response.raw_headers = [(name, v) for k, v in upstream.headers.raw
+                            if (name := k.lower()) not in SKIP_RESPONSE_HEADERS]
+    return response
+
+
+app = Starlette(routes=[
+    Route("/{path:path}", proxy_request, methods=["GET", "POST"]),
+], lifespan=lifespan)
+app.state.target_url = "https://api.anthropic.com"  # Default to Anthropic (without /v1)
+
 
 def start_proxy(port=8888, target_url="https://api.anthropic.com"):
     """Start the proxy server and keep it running"""
     try:
-        # Set the target URL for the proxy handler
-        ProxyHandler.target_url = target_url
-        
-        # Create server with SO_REUSEADDR to avoid "Address already in use" errors
-        server = socketserver.TCPServer(("", port), ProxyHandler)
-        server.allow_reuse_address = True
-        
-        # Start in a thread
-        thread = threading.Thread(target=server.serve_forever)
-        thread.daemon = True
-        thread.start()
-        
+        # Set the target URL for the proxy
+        app.state.target_url = target_url
+
         print(f"✓ Proxy server started on http://localhost:{port}")
         print(f"  Forwarding to: {target_url}")
         print(f"  Configure your client to use: http://localhost:{port}")
         print(f"  Press Ctrl+C to stop\n")
-        
-        # Keep the main thread alive
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print("\nShutting down proxy...")
-            server.shutdown()
-            
-    except OSError as e:
-        if "Address already in use" in str(e):
-            print(f"Error: Port {port} is already in use!")
-            print("Try: 1) Use a different port, or")
-            print("     2) Kill the process using this port")
-        else:
-            print(f"Error starting server: {e}")
+
+        # Serve until Ctrl+C; uvicorn handles concurrent requests on one event loop.
+        # The target's own Server and Date headers are forwarded, so uvicorn's are off.
+        uvicorn.run(
+            app,
+            host="0.0.0.0",
+            port=port,
+            log_level="warning",
+            # uvloop is not available on Windows
+            loop="asyncio" if sys.platform == "win32" else "uvloop",
+            http="httptools",
+            access_log=False,
+            server_header=False,
+            date_header=False
+        )
+        print("\nShutting down proxy...")
+
     except Exception as e:
         print(f"Unexpected error: {e}")
 
 # When running this script directly
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="HTTP proxy server for API requests")
-    parser.add_argument("--port", "-p", type=int, default=8888, 
+    parser.add_argument("--port", "-p", type=int, default=8888,
                        help="Port to listen on (default: 8888)")
     parser.add_argument("--target", "-t", type=str, default="https://api.anthropic.com",
                        help="Target URL to proxy to (default: https://api.anthropic.com)")
-    
+    parser.add_argument("--verbose", "-v", action="store_true",
+                       help="Print details of every proxied request")
+
     args = parser.parse_args()
-    
+
+    logging.basicConfig(format="%(message)s")
+    log.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
     # Remove trailing slash if present
     target_url = args.target.rstrip('/')
-    
-    start_proxy(args.port, target_url)
\ No newline at end of file
+
+    start_proxy(args.port, target_url)
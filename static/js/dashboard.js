@@ -18,6 +18,9 @@ class Dashboard {
         this.allEntries = [];
         this.currentIndex = -1;
         this.autoScrollToLatest = true;
+        this.isLoadingInitial = false;
+        this.initialTotal = 0;
+        this.pendingUpdates = [];
         
         this.setupEventListeners();
         this.connect();
@@ -111,18 +114,24 @@ class Dashboard {
             const data = JSON.parse(event.data);
             
             if (data.type === 'initial') {
-                // Initial load of all entries
+                // First page of the initial load
                 this.allEntries = data.entries || [];
-                if (this.allEntries.length > 0) {
-                    this.currentIndex = this.allEntries.length - 1;
-                    this.displayEntry(this.currentIndex);
-                } else {
-                    // No entries yet, update navigation to show 0/0
-                    this.updateNavigation();
-                }
+                this.initialTotal = data.total || 0;
+                this.pendingUpdates = [];
+                this.finishInitialLoadIfComplete();
+            } else if (data.type === 'initial_chunk') {
+                // Remaining pages of the initial load
+                this.allEntries.push(...(data.entries || []));
+                this.finishInitialLoadIfComplete();
             } else if (data.type === 'update') {
-                // New entry received
-                this.allEntries.push(data.entry);
+                // Hold updates until the initial load has been received
+                if (this.isLoadingInitial) {
+                    this.pendingUpdates.push(...(data.entries || []));
+                    return;
+                }
+                
+                // New entries received
+                this.allEntries.push(...(data.entries || []));
                 
                 // Auto-scroll to latest if enabled
                 if (this.autoScrollToLatest) {
@@ -147,6 +156,23 @@ class Dashboard {
         };
     }
 
+    finishInitialLoadIfComplete() {
+        this.isLoadingInitial = this.allEntries.length < this.initialTotal;
+        if (this.isLoadingInitial) {
+            return;
+        }
+        
+        this.allEntries.push(...this.pendingUpdates);
+        this.pendingUpdates = [];
+        if (this.allEntries.length > 0) {
+            this.currentIndex = this.allEntries.length - 1;
+            this.displayEntry(this.currentIndex);
+        } else {
+            // No entries yet, update navigation to show 0/0
+            this.updateNavigation();
+        }
+    }
+
     updateStatus(connected) {
         if (connected) {
             this.statusDot.classList.add('connected');